@@ -1,7 +1,16 @@
 import os
-import json
+import sys
+import copy
+import time
+import asyncio
+import functools
+import hashlib
 import requests
+import diskcache
+import threading
 import gradio as gr
+from cachetools import TTLCache
+from aiolimiter import AsyncLimiter
 from agno.agent import Agent
 from dotenv import load_dotenv
 from dataclasses import dataclass
@@ -12,6 +21,68 @@ from agno.models.openai import OpenAIChat
 
 load_dotenv()
 
+# Token bucket so concurrent users queue politely instead of hammering
+# Firecrawl into 429s; sized for a typical plan's requests-per-minute quota
+_FIRECRAWL_LIMITER = AsyncLimiter(10, 60)
+
+def _retry_after_seconds(exc: Exception) -> Optional[float]:
+    """Seconds to wait before retrying a rate-limited Firecrawl call,
+    or None when the exception is not a 429
+    """
+    resp = getattr(exc, "response", None)
+    if resp is not None and getattr(resp, "status_code", None) == 429:
+        header = resp.headers.get("Retry-After")
+        if header:
+            try:
+                return min(float(header), 30.0)
+            except ValueError:
+                pass
+        return 5.0
+
+    # firecrawl-py wraps some errors in plain exceptions without a response
+    message = str(exc).lower()
+    if "429" in message or "rate limit" in message:
+        return 5.0
+
+    return None
+
+# Shared Firecrawl client, built once at import when a key is configured, so
+# repeat requests reuse one client instead of re-bootstrapping it per call
+_FIRECRAWL_KEY = os.getenv("FIRECRAWL_KEY")
+_FIRECRAWL = FirecrawlApp(api_key = _FIRECRAWL_KEY) if _FIRECRAWL_KEY else None
+
+# AQI values only change every few minutes, so repeat lookups for the same
+# location within the TTL are served from memory instead of re-running the
+# Firecrawl extraction. Gradio serves handlers from a threadpool, hence the lock.
+_AQI_CACHE = TTLCache(maxsize = 512, ttl = 300)
+_AQI_CACHE_LOCK = threading.Lock()
+
+def _cache_key(country: str, state: str, city: str) -> str:
+    """Normalized key so trivially different spellings of a location collide"""
+    return f"{country}|{state}|{city}".lower().strip()
+
+# Disk-backed cache for LLM recommendations, keyed by a quantized input
+# signature so near-identical conditions replay a stored answer instead of
+# paying for another OpenAI round-trip
+_RECO_CACHE = diskcache.Cache(os.path.expanduser("~/.cache/aqi_agent"), size_limit = 2**30)
+_RECO_CACHE_TTL = 3600
+
+def _recommendation_key(aqi_data: Dict[str, float], user_input: "UserInput") -> str:
+    """Quantize the inputs (AQI to nearest 10, PM to nearest 5) and hash them,
+    so small reading fluctuations still hit the same cached recommendation
+    """
+    signature = "|".join([
+        str(round(aqi_data.get("aqi", 0) / 10) * 10),
+        str(round(aqi_data.get("pm25", 0) / 5) * 5),
+        str(round(aqi_data.get("pm10", 0) / 5) * 5),
+        (user_input.medical_conditions or "").lower().strip(),
+        user_input.planned_activity.lower().strip(),
+        user_input.city.lower().strip(),
+        user_input.state.lower().strip(),
+        user_input.country.lower().strip()
+    ])
+    return hashlib.blake2b(signature.encode()).hexdigest()
+
 class AQIResponse(BaseModel):
     success: bool
     data: Dict[str, float]
@@ -26,8 +97,16 @@ class ExtractSchema(BaseModel):
     pm25:float = Field(description = "Particulate Matter 2.5 micrometers")
     pm10:float = Field(description = "Particulate Matter 10 micrometers")
     co: float = Field(description = "Carbon Monoxide Level")
-    
-@dataclass
+
+# Both are compile-time constants; build them once instead of regenerating
+# the pydantic schema on every request
+_EXTRACT_SCHEMA = ExtractSchema.model_json_schema()
+_EXTRACT_PROMPT = "Extract the current real-time AQI, temperature, humidity, wind speed, PM2.5, PM10 and CO Levels from the page. Also extract the timestamp of the data."
+
+
+# slots drops the per-instance __dict__ and frozen makes instances
+# hashable, so they can double as cache keys
+@dataclass(slots = True, frozen = True)
 class UserInput:
     city: str
     state: str
@@ -37,54 +116,83 @@ class UserInput:
     
 class AQIAnalyzer:
     
-    def __init__(self, firecrawl_key : str) -> None:
-        self.firecrawl = FirecrawlApp(api_key = firecrawl_key)
+    def __init__(self, firecrawl_key : Optional[str] = None) -> None:
+        if firecrawl_key and firecrawl_key != _FIRECRAWL_KEY:
+            self.firecrawl = FirecrawlApp(api_key = firecrawl_key)
+        elif _FIRECRAWL is not None:
+            self.firecrawl = _FIRECRAWL
+        else:
+            self.firecrawl = FirecrawlApp(api_key = firecrawl_key)
     
-    def _format_url(self, country : str, state: str, city: str) -> str:
+    @staticmethod
+    @functools.lru_cache(maxsize = 256)
+    def _format_url(country : str, state: str, city: str) -> str:
         """Format URLs based on location, handling cases with and without state
         """
         country_clean = country.lower().replace(" ", "-")
         city_clean = city.lower().replace(" ", "-")
-        
-        if not state or state.lower().replace(" ","-"):
+
+        if not state or not state.strip():
             return f"https://www.aqi.in/dashboard/{country_clean}/{city_clean}"
-        
+
         state_clean = state.lower().replace(" ", "-")
         return f"https://www.aqi.in/dashboard/{country_clean}/{state_clean}/{city_clean}"
-        
+
     
-    def fetch_aqi_data(self, city: str, state: str, country: str) -> tuple[Dict[str, float], str]:
-        """Fetch API data using Firecrawl"""
+    def cached_aqi_data(self, city: str, state: str, country: str) -> Optional[tuple[Dict[str, float], str]]:
+        """Return a cached (data, message) pair for the location, or None on a miss"""
+        key = _cache_key(country, state, city)
+        with _AQI_CACHE_LOCK:
+            cached = _AQI_CACHE.get(key)
+        if cached is None:
+            return None
+        # Deep copy so callers can't mutate the cached entry
+        return copy.deepcopy(cached), f"Serving cached AQI data for {city}"
+
+    def fetch_aqi_data(self, city: str, state: str, country: str, force_refresh: bool = False) -> tuple[Optional[Dict[str, float]], str]:
+        """Fetch API data using Firecrawl, serving repeat lookups from the TTL cache.
+        Returns (None, error message) when the fetch fails.
+        """
+        if not force_refresh:
+            cached = self.cached_aqi_data(city, state, country)
+            if cached is not None:
+                return cached
+
+        key = _cache_key(country, state, city)
+
         try:
             url = self._format_url(country, state, city)
             info_msg = f"Accessing URL: {url}"
-            
-            resp = self.firecrawl.extract(
-                urls = [f"{url}/*"],
-                params = {
-                    "prompt" : "Extract the current real-time AQI, temperature, humidity, wind speed, PM2.5, PM10 and CO Levels from the page. Also extract the timestamp of the data.",
-                    "schema": ExtractSchema.model_json_schema()
-                }
-            )
-            
+            params = {
+                "prompt" : _EXTRACT_PROMPT,
+                "schema": _EXTRACT_SCHEMA
+            }
+
+            try:
+                resp = self.firecrawl.extract(urls = [f"{url}/*"], params = params)
+            except Exception as e:
+                # Rate limited: honor Retry-After and try once more rather
+                # than surfacing the 429 as a failed fetch
+                wait = _retry_after_seconds(e)
+                if wait is None:
+                    raise
+                time.sleep(wait)
+                resp = self.firecrawl.extract(urls = [f"{url}/*"], params = params)
+
+
             aqi_response = AQIResponse(**resp)
             
             if not aqi_response.success:
                 raise requests.HTTPError(f"Failed to fetch AQI Data: {aqi_response.status}")
-            
+
+            with _AQI_CACHE_LOCK:
+                _AQI_CACHE[key] = copy.deepcopy(aqi_response.data)
+
             return aqi_response.data, info_msg
         
         except Exception as e:
             error_msg = f"Error Fetching AQI Data: {str(e)}"
-            return {
-                "api": 0,
-                "temperature": 0,
-                "humidity": 0,
-                "wind_speed": 0,
-                "pm25": 0,
-                "pm10": 0,
-                "co": 0
-            }, error_msg
+            return None, error_msg
 
 class HealthRecommendationAgent:
     
@@ -98,61 +206,135 @@ class HealthRecommendationAgent:
         )
         
     def _create_prompt(self, aqi_data: Dict[str, float], user_input: UserInput) -> str:
+        # Single unpack instead of repeated dict lookups in the f-string
+        aqi, pm25, pm10, co, temp, hum, wind = (
+            aqi_data[k] for k in ("aqi", "pm25", "pm10", "co", "temperature", "humidity", "wind_speed")
+        )
+
+        # Invariant instructions come first and variable data last, so
+        # OpenAI's server-side prompt-prefix cache can reuse the static block
         return f"""
-        Based on the following air quality condition in {user_input.city}, {user_input.state}, {user_input.country}:
-        - Overall AQI: {aqi_data["aqi"]}
-        - PM2.5 Level: {aqi_data["pm25"]} µg/m³
-        - PM10 Level: {aqi_data["pm10"]} µg/m³
-        - CO Level: {aqi_data["co"]} ppb
-        
+        You are a health advisor. Provide comprehensive health recommendations covering:
+        1. **Impact of Current Air Quality on Health:**
+        2. **Necessary Safety Precautions for Planned Activity:**
+        3. **Advisability of Planned Activity:**
+        4. **Best Time to Conduct the Activity:**
+
+        Base your recommendations on the following air quality condition in {user_input.city}, {user_input.state}, {user_input.country}:
+        - Overall AQI: {aqi}
+        - PM2.5 Level: {pm25} µg/m³
+        - PM10 Level: {pm10} µg/m³
+        - CO Level: {co} ppb
+
         Weather Conditions:
-        - Temperature: {aqi_data["temperature"]}°C
-        - Humidity: {aqi_data["humidity"]}%
-        - Wind Speed: {aqi_data["co"]} ppb
-    """ 
-    
+        - Temperature: {temp}°C
+        - Humidity: {hum}%
+        - Wind Speed: {wind} km/h
+
+        User's Context:
+        - Medical Conditions: {user_input.medical_conditions or "None"}
+        - Planned Activity: {user_input.planned_activity}
+    """
+
     def get_recommendation(self, aqi_data: Dict[str, float], user_input: UserInput) -> str:
-        prompt = self._create_prompt(prompt)
+        key = _recommendation_key(aqi_data, user_input)
+        cached = _RECO_CACHE.get(key)
+        if cached is not None:
+            return cached
+
+        prompt = self._create_prompt(aqi_data, user_input)
         resp = self.agent.run(prompt)
-        
+
+        _RECO_CACHE.set(key, resp.content, expire = _RECO_CACHE_TTL)
         return resp.content
 
-def analyze_conditions(city: str, state: str, country: str, medical_condition: str, planned_activity: str, firecrawl_key: str, openai_key: str) -> tuple[str, str, str, str]:
-    """Analyze condition and return AQI data, recommendation, and status messages"""
+    def stream_recommendation(self, aqi_data: Dict[str, float], user_input: UserInput):
+        """Yield the accumulated recommendation text as tokens arrive.
+        Cache hits replay the stored answer in a single yield.
+        """
+        key = _recommendation_key(aqi_data, user_input)
+        cached = _RECO_CACHE.get(key)
+        if cached is not None:
+            yield cached
+            return
+
+        prompt = self._create_prompt(aqi_data, user_input)
+        chunks = []
+        for resp in self.agent.run(prompt, stream = True):
+            if resp.content:
+                chunks.append(resp.content)
+                yield "".join(chunks)
+
+        _RECO_CACHE.set(key, "".join(chunks), expire = _RECO_CACHE_TTL)
+
+# Client bootstrap (FirecrawlApp, Agent, OpenAIChat) sets up HTTP clients and
+# reads config, so reuse one instance per API key instead of rebuilding per click
+@functools.lru_cache(maxsize = 4)
+def _get_analyzer(firecrawl_key: Optional[str]) -> AQIAnalyzer:
+    return AQIAnalyzer(firecrawl_key = firecrawl_key)
+
+@functools.lru_cache(maxsize = 4)
+def _get_health_agent(openai_key: str) -> HealthRecommendationAgent:
+    return HealthRecommendationAgent(openai_key = openai_key)
+
+async def analyze_conditions(city: str, state: str, country: str, medical_condition: str, planned_activity: str, force_refresh: bool, firecrawl_key: str, openai_key: str):
+    """Analyze condition and stream AQI data, recommendation, and status messages.
+    Yields the AQI data as soon as it arrives, then incremental recommendation text.
+    """
     try:
-        # initialize the analyzer
-        aqi_analyzer = AQIAnalyzer(firecrawl_key=firecrawl_key)
-        health_agent = HealthRecommendationAgent(openai_key = openai_key)
-        
-        # Create user input
+        # Reuse the per-key client singletons
+        aqi_analyzer = _get_analyzer(firecrawl_key)
+        health_agent = _get_health_agent(openai_key)
+
+        # Create user input; locations draw from a small vocabulary, so
+        # interning shares one string object across repeat requests
         user_input = UserInput(
-            city = city, 
-            state = state,
-            country = country,
+            city = sys.intern(city),
+            state = sys.intern(state),
+            country = sys.intern(country),
             medical_conditions = medical_condition,
             planned_activity = planned_activity
         )
         
-        # Get AQI Data
-        aqi_data, info_msg = aqi_analyzer.fetch_aqi_data(
+        # Serve cache hits without touching the token bucket; only real
+        # Firecrawl traffic should consume rate-limit capacity
+        cached = None if force_refresh else aqi_analyzer.cached_aqi_data(
             city = user_input.city,
             state = user_input.state,
             country = user_input.country
         )
+        if cached is not None:
+            aqi_data, info_msg = cached
+        else:
+            # Fetch off the event loop (the Firecrawl client is synchronous),
+            # pacing egress through the token bucket so we self-throttle
+            # before Firecrawl starts returning 429s
+            async with _FIRECRAWL_LIMITER:
+                aqi_data, info_msg = await asyncio.to_thread(
+                    aqi_analyzer.fetch_aqi_data,
+                    city = user_input.city,
+                    state = user_input.state,
+                    country = user_input.country,
+                    force_refresh = force_refresh
+                )
         
-        # Format AQI data for display
-        aqi_json = json.dumps({
+        # Failed fetch: there is nothing meaningful to recommend on, so skip
+        # the OpenAI round-trip entirely
+        if aqi_data is None:
+            yield None, "⚠️ Could not fetch AQI data — please retry.", info_msg, ""
+            return
+
+        # Format AQI data for display; gr.JSON takes the dict directly and
+        # serializes it server-side, so no intermediate string is needed
+        aqi_json = {
             "Air Quality Index (AQI): ": aqi_data["aqi"],
-            "PM2.5: ":f"{aqi_data["pm25"]} µg/m³",
-            "PM10: ": f"{aqi_data["pm10"]} µg/m³",
-            "Carbon Monoxide (CO): " : f"{aqi_data["co"]} ppb",
+            "PM2.5: ":f"{aqi_data['pm25']} µg/m³",
+            "PM10: ": f"{aqi_data['pm10']} µg/m³",
+            "Carbon Monoxide (CO): " : f"{aqi_data['co']} ppb",
             "Temperature": f"{aqi_data['temperature']}°C",
             "Humidity": f"{aqi_data['humidity']}%",
             "Wind Speed": f"{aqi_data['wind_speed']} km/h"
-        }, indent=2)
-        
-        # Get Recommendations
-        recommendations = health_agent.get_recommendation(aqi_data, user_input)
+        }
         
         warning_msg = """
         Note: The data shown may not match real-time values on the website.
@@ -160,20 +342,29 @@ def analyze_conditions(city: str, state: str, country: str, medical_condition: s
         - Cached data in Firecrawl
         - Rate Limiting
         - Website updates not being captured
-        
+
         Consider refreshing or checking the website directly for real-time values
         """
-        
-        return aqi_json, recommendations, info_msg, warning_msg
-    
+
+        # Paint the AQI data immediately, before the LLM starts answering
+        yield aqi_json, "", info_msg, warning_msg
+
+        stream = health_agent.stream_recommendation(aqi_data, user_input)
+        while True:
+            # Pull each chunk off the event loop; the agno stream is synchronous
+            text = await asyncio.to_thread(next, stream, None)
+            if text is None:
+                break
+            yield aqi_json, text, info_msg, warning_msg
+
     except Exception as e:
         error_msg = f"Error Occured: {str(e)}"
-        return "", "Analysis Failed", error_msg, ""
+        yield None, "Analysis Failed", error_msg, ""
     
 def create_demo() -> gr.Blocks:
     """Create and configure the gradio interface"""
     
-    with gr.Blocks(title = "AQL Analysis and Recommendation Agent") as Demo:
+    with gr.Blocks(title = "AQL Analysis and Recommendation Agent") as demo:
         gr.Markdown(
             """
             AQI Analysis Agent
@@ -228,6 +419,11 @@ def create_demo() -> gr.Blocks:
         recommendations = gr.Markdown(label="Health Recommendations")
         
         # Analyze Button
+        force_refresh = gr.Checkbox(
+            label="Force Refresh",
+            value=False,
+            info="Bypass the cache and fetch fresh AQI data"
+        )
         analyze_btn = gr.Button("🔍 Analyze & Get Recommendations", variant="primary")
         analyze_btn.click(
             fn=analyze_conditions,
@@ -237,10 +433,12 @@ def create_demo() -> gr.Blocks:
                 country,
                 medical_conditions,
                 planned_activity,
+                force_refresh,
                 firecrawl_key,
                 openai_key
             ],
-            outputs=[aqi_data_json, recommendations, info_box, warning_box]
+            outputs=[aqi_data_json, recommendations, info_box, warning_box],
+            concurrency_limit=8
         )
         
         # Examples
@@ -258,4 +456,7 @@ def create_demo() -> gr.Blocks:
 
 if __name__ == "__main__":
     demo = create_demo()
+    # The workload is entirely IO-bound (Firecrawl + OpenAI), so let several
+    # users be mid-flight at once rather than serializing through one worker
+    demo.queue(default_concurrency_limit=8, max_size=64)
     demo.launch(share=True)
\ No newline at end of file